@@ -1,14 +1,26 @@
 import praw
+from praw.exceptions import RedditAPIException
+import prawcore
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import re
 import time
+import random
 import logging
 import os
-from datetime import datetime, timedelta  # Added missing timedelta import
+from datetime import datetime
 from dotenv import load_dotenv
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from cachetools import TTLCache, cached
 import threading
+import queue
+import signal
 import sys
+import heapq
+from collections import Counter
 from decimal import Decimal  # Import Decimal type
 import traceback  # For better error reporting
 
@@ -28,158 +40,322 @@ logging.basicConfig(
 logger = logging.getLogger("LoanCentral")
 
 # Reddit API credentials
-reddit = praw.Reddit(
+def reddit_client(**settings):
+    return praw.Reddit(
         client_id=os.getenv("REDDIT_CLIENT_ID"),
-    client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
-    username=os.getenv("REDDIT_USERNAME"),
-    password=os.getenv("REDDIT_PASSWORD"),
-    user_agent=os.getenv("REDDIT_USER_AGENT")
-)
+        client_secret=os.getenv("REDDIT_CLIENT_SECRET"),
+        username=os.getenv("REDDIT_USERNAME"),
+        password=os.getenv("REDDIT_PASSWORD"),
+        user_agent=os.getenv("REDDIT_USER_AGENT"),
+        **settings
+    )
+
+reddit = reddit_client()
+# PRAW isn't thread-safe, so every thread that makes requests has its own
+# instance: reddit for the stream thread, this one for the command worker
+WORKER_REDDIT = reddit_client()
+
+# The same comment or post on another Reddit instance. Only the id is read, so
+# this makes no request; the new object fetches its own data when first used
+def rebind(target, client):
+    if isinstance(target, praw.models.Submission):
+        return client.submission(id=target.id)
+    return client.comment(id=target.id)
+
+# The bot's own username, lowercased once for comparisons
+BOT_USERNAME = os.getenv("REDDIT_USERNAME", "").lower()
+# Spellings of the bot's name as Reddit may report it, so author checks are a
+# set lookup instead of a .lower() per comment; the account's canonical
+# spelling is added when the streams start
+BOT_NAMES = {os.getenv("REDDIT_USERNAME", ""), BOT_USERNAME, BOT_USERNAME.upper()}
+
+# Home subreddit: [REQ] posts are read from here and refunds reported to its mods
+SUBREDDIT_NAME = os.getenv("SUBREDDIT", "")
 
 # Multi-subreddit support
-SUBREDDITS = os.getenv("SUBREDDITS", os.getenv("SUBREDDIT", "")).replace(" ", "").split(",")
+SUBREDDITS = os.getenv("SUBREDDITS", SUBREDDIT_NAME).replace(" ", "").split(",")
 SUBREDDITS = [s for s in SUBREDDITS if s]
 if SUBREDDITS:
     subreddit_str = "+".join(SUBREDDITS)
 else:
     logger.warning("No subreddits specified. Falling back to single SUBREDDIT env var.")
-    subreddit_str = os.getenv("SUBREDDIT", "")
+    subreddit_str = SUBREDDIT_NAME
  
+# Command patterns, compiled once at import instead of on every comment
+LOAN_RE = re.compile(r'\$loan\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})', re.IGNORECASE)
+# Backtick-free body, so the scan never backtracks across the comment
+CODE_BLOCK_RE = re.compile(r'```([^`]*)```')
+# "/?u/" accepts both "/u/name" and "u/name"
+CONFIRM_LENDER_RE = re.compile(r'\$confirm\s+/?u/([^\s]+)', re.IGNORECASE)
+CONFIRM_RE = re.compile(r'\$confirm\s+/?u/([^\s]+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})', re.IGNORECASE)
+PAID_RE = re.compile(r'\$paid_with_id\s+(\d+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})', re.IGNORECASE)
+REFUNDED_RE = re.compile(r'refunded', re.IGNORECASE)
+REFUND_RE = re.compile(r'u/([^\s]+) has confirmed receiving (\d+(?:\.\d+)?)\s+([A-Z]{3}) from u/([^\s\.]+)')
+UNPAID_RE = re.compile(r'\$unpaid\s+(\d+)\s+u?/?([\w-]+)', re.IGNORECASE)
+STATS_RE = re.compile(r"\$stats\s+(?:/u/|u/)([^\s]+)", re.IGNORECASE)
+REPAID_RE = re.compile(r"\$repaid\s+(\d+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})", re.IGNORECASE)
+REQ_TITLE_RE = re.compile(r'\[req\]', re.IGNORECASE)
+
+# PostgreSQL connection pool, so each command reuses an open connection
+# instead of reconnecting to Postgres. Commands run on the command worker
+# thread, which holds at most one connection at a time.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+POOL = None
 
-# PostgreSQL connection
-def get_db_connection():
+# Connection that remembers which statements it has already PREPAREd, so each
+# pooled connection prepares a statement once and reuses it for every command
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def init_db_pool():
+    global POOL
     try:
-        conn = psycopg2.connect(
+        POOL = psycopg2.pool.ThreadedConnectionPool(
+            DB_POOL_MIN,
+            DB_POOL_MAX,
             host=os.getenv("DB_HOST"),
             database=os.getenv("DB_NAME"),
             user=os.getenv("DB_USER"),
             password=os.getenv("DB_PASSWORD"),
-            port=os.getenv("DB_PORT")
+            port=os.getenv("DB_PORT"),
+            connection_factory=PreparingConnection
         )
-        return conn
+        return True
     except Exception as e:
-        logger.error(f"Database connection error: {e}")
-        logger.error(traceback.format_exc())  # Added consistent error logging
-        return None
-
-# Initialize database tables if they don't exist
-def init_database():
-    conn = get_db_connection()
-    if not conn:
+        logger.error("Database connection error: %s", e)
+        logger.error(traceback.format_exc())
         return False
-    
-    cur = conn.cursor()
+
+# Borrow a connection from the pool; yields None if no connection is available
+@contextmanager
+def db_conn():
+    conn = None
     try:
-        # Create loans table
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS loans (
-                id SERIAL PRIMARY KEY,
-                loan_id TEXT UNIQUE,
-                lender TEXT NOT NULL,
-                borrower TEXT NOT NULL,
-                amount NUMERIC NOT NULL,
-                currency TEXT NOT NULL,
-                date_created TIMESTAMP NOT NULL,
-                original_thread TEXT NOT NULL,
-                status TEXT DEFAULT 'active',
-                amount_repaid NUMERIC DEFAULT 0,
-                last_updated TIMESTAMP
-            )
-        ''')
-        
-        # Create users table to track user statistics
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                loans_as_borrower INTEGER DEFAULT 0,
-                loans_as_lender INTEGER DEFAULT 0,
-                amount_borrowed NUMERIC DEFAULT 0,
-                amount_lent NUMERIC DEFAULT 0,
-                amount_repaid NUMERIC DEFAULT 0,
-                unpaid_loans INTEGER DEFAULT 0,
-                unpaid_amount NUMERIC DEFAULT 0,
-                last_updated TIMESTAMP
-            )
-        ''')
-
-        # Create indexes for better performance
-        cur.execute('''
-            CREATE INDEX IF NOT EXISTS idx_loans_lender ON loans(lender);
-            CREATE INDEX IF NOT EXISTS idx_loans_borrower ON loans(borrower);
-            CREATE INDEX IF NOT EXISTS idx_loans_status ON loans(status);
-            CREATE INDEX IF NOT EXISTS idx_loans_date_created ON loans(date_created);
-        ''')
-        
-        conn.commit()
-        logger.info("Database initialized successfully")
-        return True
+        conn = POOL.getconn()
     except Exception as e:
-        conn.rollback()
-        logger.error(f"Database initialization error: {e}")
+        logger.error("Database connection error: %s", e)
         logger.error(traceback.format_exc())  # Added consistent error logging
-        return False
+    try:
+        yield conn
     finally:
-        cur.close()
-        conn.close()
+        if conn:
+            try:
+                # Discard any transaction left open by an early return
+                conn.rollback()
+                POOL.putconn(conn)
+            except Exception:
+                POOL.putconn(conn, close=True)
+
+# Execute a statement through a server-side prepared statement, preparing it on
+# first use for this connection. The SQL uses PostgreSQL's $1, $2, ... placeholders.
+def execute_prepared(cur, name, sql, params):
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+# Initialize database tables if they don't exist
+def init_database():
+    with db_conn() as conn:
+        if not conn:
+            return False
+
+        with conn.cursor() as cur:
+            try:
+                # Create loans table
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS loans (
+                        id SERIAL PRIMARY KEY,
+                        loan_id TEXT UNIQUE,
+                        lender TEXT NOT NULL,
+                        borrower TEXT NOT NULL,
+                        amount NUMERIC NOT NULL,
+                        currency TEXT NOT NULL,
+                        date_created TIMESTAMP NOT NULL,
+                        original_thread TEXT NOT NULL,
+                        status TEXT DEFAULT 'active',
+                        amount_repaid NUMERIC DEFAULT 0,
+                        last_updated TIMESTAMP
+                    )
+                ''')
+
+                # Create users table to track user statistics
+                cur.execute('''
+                    CREATE TABLE IF NOT EXISTS users (
+                        username TEXT PRIMARY KEY,
+                        loans_as_borrower INTEGER DEFAULT 0,
+                        loans_as_lender INTEGER DEFAULT 0,
+                        amount_borrowed NUMERIC DEFAULT 0,
+                        amount_lent NUMERIC DEFAULT 0,
+                        amount_repaid NUMERIC DEFAULT 0,
+                        unpaid_loans INTEGER DEFAULT 0,
+                        unpaid_amount NUMERIC DEFAULT 0,
+                        last_updated TIMESTAMP
+                    )
+                ''')
+
+                # Create indexes for better performance
+                cur.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_loans_lender ON loans(lender);
+                    CREATE INDEX IF NOT EXISTS idx_loans_borrower ON loans(borrower);
+                    CREATE INDEX IF NOT EXISTS idx_loans_date_created ON loans(date_created);
+
+                    -- Partial indexes over unpaid loans; these replace the low-selectivity
+                    -- idx_loans_status and serve generate_user_info's ORDER BY ... LIMIT
+                    -- straight from the index
+                    DROP INDEX IF EXISTS idx_loans_status;
+                    CREATE INDEX IF NOT EXISTS idx_loans_lender_unpaid ON loans(lender, date_created DESC)
+                        WHERE status IN ('active', 'confirmed', 'partially_repaid');
+                    CREATE INDEX IF NOT EXISTS idx_loans_borrower_unpaid ON loans(borrower, date_created DESC)
+                        WHERE status IN ('active', 'confirmed', 'partially_repaid');
+
+                    -- Matches process_refund_command's lookup so the newest matching
+                    -- loan comes straight off the index without a sort
+                    CREATE INDEX IF NOT EXISTS idx_loans_refund_lookup
+                        ON loans(lender, borrower, currency, amount, date_created DESC);
+                ''')
+
+                conn.commit()
+                logger.info("Database initialized successfully")
+                return True
+            except Exception as e:
+                conn.rollback()
+                logger.error("Database initialization error: %s", e)
+                logger.error(traceback.format_exc())  # Added consistent error logging
+                return False
+
+
+# Replies are posted from a reply thread so the command worker doesn't wait
+# on Reddit's reply endpoint before handling the next command. PRAW isn't
+# thread-safe, so the thread has its own Reddit instance and is the only one
+# using it
+# Seconds before a reply request times out, which bounds the reply still in
+# flight when the process shuts down
+REPLY_TIMEOUT = 8
+REPLY_REDDIT = reddit_client(timeout=REPLY_TIMEOUT)
+REPLY_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reply")
+REPLY_MAX_ATTEMPTS = 5
+# Set at shutdown so rate-limited replies stop waiting and are dropped
+REPLY_SHUTDOWN = threading.Event()
+# Wait Reddit asks for in a RATELIMIT message, e.g. "try again in 9 minutes"
+RATELIMIT_WAIT_RE = re.compile(r'(\d+) (millisecond|second|minute)')
+
+# Seconds Reddit asked us to wait in a RATELIMIT error, or None if it didn't say
+def ratelimit_wait(exception):
+    for item in exception.items:
+        if item.error_type != "RATELIMIT":
+            continue
+        match = RATELIMIT_WAIT_RE.search(item.message)
+        if not match:
+            return None
+        amount, unit = int(match.group(1)), match.group(2)
+        if unit == "minute":
+            return amount * 60 + 1
+        if unit == "second":
+            return amount + 1
+        return 1
+    return None
+
+# Post a reply, waiting out Reddit's rate limit; falls back to exponential
+# backoff when the error doesn't say how long to wait
+def safe_reply(target, text):
+    delay = 10
+    for attempt in range(1, REPLY_MAX_ATTEMPTS + 1):
+        try:
+            target.reply(text)
+            return
+        except RedditAPIException as e:
+            rate_limited = any(item.error_type == "RATELIMIT" for item in e.items)
+            if not rate_limited or attempt == REPLY_MAX_ATTEMPTS:
+                logger.error("Error posting reply: %s", e)
+                logger.error(traceback.format_exc())
+                return
+            wait = ratelimit_wait(e) or delay
+            logger.warning("Rate limited while replying, retrying in %s seconds", wait)
+            if REPLY_SHUTDOWN.wait(wait):
+                logger.warning("Shutting down, dropping rate-limited reply")
+                return
+            delay *= 2
+        except Exception as e:
+            logger.error("Error posting reply: %s", e)
+            logger.error(traceback.format_exc())
+            return
 
+# Queue a reply on the reply thread, rebound to that thread's Reddit instance
+def send_reply(target, text):
+    try:
+        REPLY_POOL.submit(safe_reply, rebind(target, REPLY_REDDIT), text)
+    except RuntimeError:
+        # The reply pool has been shut down; the process is exiting
+        logger.warning("Shutting down, dropping reply")
 
 # Decorator to prevent duplicate confirmations
 def confirm_restriction(func):
     @wraps(func)
     def wrapper(comment):
-        # Check if this is a re-confirmation
-        conn = get_db_connection()
-        if not conn:
-            return func(comment)  # Proceed anyway if we can't check
+        # Extract lender from the command - similar to what's in the function
+        match = CONFIRM_LENDER_RE.search(comment.body)
+        if not match:
+            return func(comment)  # Can't find lender, let the function handle it
         
-        try:
-            cur = conn.cursor()
-            # Extract borrower from comment
-            borrower = comment.author.name.lower()
-            
-            # Extract lender from the command - similar to what's in the function
-            confirm_regex = r'\$confirm\s+\/u\/([^\s]+)'
-            match = re.search(confirm_regex, comment.body, re.IGNORECASE)
-            if not match:
-                alt_confirm_regex = r'\$confirm\s+u\/([^\s]+)'
-                match = re.search(alt_confirm_regex, comment.body, re.IGNORECASE)
-                if not match:
-                    return func(comment)  # Can't find lender, let the function handle it
-            
-            lender = match.group(1).lower()
-            
-            # Check if this loan already exists
-            cur.execute('''
-                SELECT id FROM loans
-                WHERE lender = %s AND borrower = %s AND status = 'confirmed'
-                ORDER BY date_created DESC
-                LIMIT 1
-            ''', (lender, borrower))
+        lender = match.group(1).lower()
+        
+        # Check if this is a re-confirmation. The connection goes back to the
+        # pool before the wrapped function borrows its own.
+        with db_conn() as conn:
+            if not conn:
+                return func(comment)  # Proceed anyway if we can't check
             
-            existing = cur.fetchone()
+            with conn.cursor() as cur:
+                try:
+                    # Extract borrower from comment
+                    borrower = comment.author.name.lower()
+                    
+                    # Check if this loan already exists
+                    cur.execute('''
+                        SELECT id FROM loans
+                        WHERE lender = %s AND borrower = %s AND status = 'confirmed'
+                        ORDER BY date_created DESC
+                        LIMIT 1
+                    ''', (lender, borrower))
+                    
+                    existing = cur.fetchone()
+                except Exception as e:
+                    logger.error("Error in confirm_restriction: %s", e)
+                    logger.error(traceback.format_exc())
+                    existing = None  # Proceed anyway if there's an error
+        
+        try:
             if existing:
-                comment.reply(f"Error: You have already confirmed a loan with u/{lender}. If this is a new loan, please ask the lender to use a new $loan command.")
+                send_reply(comment, f"Error: You have already confirmed a loan with u/{lender}. If this is a new loan, please ask the lender to use a new $loan command.")
                 return  # Skip the wrapped function
                 
             # Check if commenter is the OP of the post
             post = comment.submission
             if comment.author.name.lower() != post.author.name.lower():
-                comment.reply(f"Error: Only the original requester (u/{post.author.name}) can confirm this loan. If you're the requester but using a different account, please contact the moderators.")
+                send_reply(comment, f"Error: Only the original requester (u/{post.author.name}) can confirm this loan. If you're the requester but using a different account, please contact the moderators.")
                 return
-                
-            return func(comment)  # Everything looks good, proceed with the function
-            
         except Exception as e:
-            logger.error(f"Error in confirm_restriction: {e}")
+            logger.error("Error in confirm_restriction: %s", e)
             logger.error(traceback.format_exc())
-            return func(comment)  # Proceed anyway if there's an error
-        finally:
-            if conn:
-                cur.close()
-                conn.close()
+            
+        return func(comment)  # Everything looks good, proceed with the function
     
     return wrapper
 
+# Text to search for a command - the first code block if there is one,
+# otherwise the full comment body
+def extract_command_text(body):
+    if "```" in body:
+        match = CODE_BLOCK_RE.search(body)
+        if match:
+            return match.group(1).strip()
+    return body
+
 # Generate a unique loan ID
 def generate_loan_id():
     current_time = int(time.time())
@@ -187,8 +363,7 @@ def generate_loan_id():
 
 # Process $loan command
 def process_loan_command(comment):
-    loan_regex = r'\$loan\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})'
-    match = re.search(loan_regex, comment.body, re.IGNORECASE)
+    match = LOAN_RE.search(comment.body)
     
     if not match:
         return
@@ -200,7 +375,7 @@ def process_loan_command(comment):
     currency = match.group(2).upper()
     
     if borrower == lender:
-        logger.warning(f"User {lender} attempted to lend to themselves")
+        logger.warning("User %s attempted to lend to themselves", lender)
         return
     
     loan_id = generate_loan_id()
@@ -220,93 +395,93 @@ $confirm /u/{lender} {amount:.2f} {currency}
 
 The loan will only be registered in the database after confirmation. This helps ensure that the money was actually sent and received.
 '''
-        comment.reply(reply_text)
-        logger.info(f"Loan offer recorded: {lender} is offering {amount} {currency} to {borrower}")
+        send_reply(comment, reply_text)
+        logger.info("Loan offer recorded: %s is offering %s %s to %s", lender, amount, currency, borrower)
         
     except Exception as e:
-        logger.error(f"Error processing loan command: {e}")
+        logger.error("Error processing loan command: %s", e)
         logger.error(traceback.format_exc())  # Log full stack trace
 
 # Process $confirm command
 @confirm_restriction
 def process_confirm_command(comment):
     # First, check if the command is in a code block and extract it
-    code_block_regex = r'```\s*(.*?)\s*```'
-    code_blocks = re.findall(code_block_regex, comment.body, re.DOTALL)
-    
-    # Text to search - either the code block content or the full comment body
-    text_to_search = code_blocks[0] if code_blocks else comment.body
+    text_to_search = extract_command_text(comment.body)
     
     # Now search for the confirm command
-    confirm_regex = r'\$confirm\s+\/u\/([^\s]+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})'
-    match = re.search(confirm_regex, text_to_search, re.IGNORECASE)
+    match = CONFIRM_RE.search(text_to_search)
     
     if not match:
-        # Try alternate format without /u/
-        alt_confirm_regex = r'\$confirm\s+u\/([^\s]+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})'
-        match = re.search(alt_confirm_regex, text_to_search, re.IGNORECASE)
-        if not match:
-            return
+        return
     
     borrower = comment.author.name.lower()
     lender = match.group(1).lower()
     amount = Decimal(match.group(2))
     currency = match.group(3).upper()
     
+    # The lender and borrower stats are upserted in one statement, which
+    # cannot touch the same users row twice
+    if borrower == lender:
+        logger.warning("User %s attempted to confirm a loan from themselves", borrower)
+        return
+    
     # Rest of the function remains the same...
     # This is where we'll actually create the loan
     loan_id = generate_loan_id()
     post = comment.submission
     thread_url = f"https://www.reddit.com{post.permalink}"
     
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    try:
-        cur = conn.cursor()
-        
-        # Insert loan
-        cur.execute('''
-            INSERT INTO loans 
-            (loan_id, lender, borrower, amount, currency, date_created, original_thread, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (loan_id, lender, borrower, amount, currency, datetime.now(), thread_url, 'confirmed'))
-        
-        db_id = cur.fetchone()[0]
-        
-        
-        # Update user statistics
-        # Update lender stats
-        cur.execute('''
-            INSERT INTO users 
-            (username, loans_as_lender, amount_lent, last_updated)
-            VALUES (%s, 1, %s, %s)
-            ON CONFLICT (username) 
-            DO UPDATE SET 
-                loans_as_lender = users.loans_as_lender + 1,
-                amount_lent = users.amount_lent + %s,
-                last_updated = %s
-        ''', (lender, amount, datetime.now(), amount, datetime.now()))
-        
-        # Update borrower stats
-        cur.execute('''
-            INSERT INTO users 
-            (username, loans_as_borrower, amount_borrowed, last_updated)
-            VALUES (%s, 1, %s, %s)
-            ON CONFLICT (username) 
-            DO UPDATE SET 
-                loans_as_borrower = users.loans_as_borrower + 1,
-                amount_borrowed = users.amount_borrowed + %s,
-                last_updated = %s
-        ''', (borrower, amount, datetime.now(), amount, datetime.now()))
-        
-        conn.commit()
-        logger.info(f"Confirmed loan: {borrower} confirmed receiving {amount} {currency} from {lender}")
+    with db_conn() as conn:
+        if not conn:
+            return
         
-        # Reply to the comment
-        reply_text = f'''
+        with conn.cursor() as cur:
+            try:
+                # Insert loan and update lender and borrower stats in one round trip
+                execute_prepared(cur, 'confirm_loan', '''
+                    WITH new_loan AS (
+                        INSERT INTO loans 
+                        (loan_id, lender, borrower, amount, currency, date_created, original_thread, status)
+                        VALUES ($1, $2, $3, $4, $5, now(), $6, 'confirmed')
+                        RETURNING id
+                    ),
+                    lender_stats AS (
+                        INSERT INTO users 
+                        (username, loans_as_lender, amount_lent, last_updated)
+                        VALUES ($2, 1, $4, now())
+                        ON CONFLICT (username) 
+                        DO UPDATE SET 
+                            loans_as_lender = users.loans_as_lender + 1,
+                            amount_lent = users.amount_lent + EXCLUDED.amount_lent,
+                            last_updated = EXCLUDED.last_updated
+                    ),
+                    borrower_stats AS (
+                        INSERT INTO users 
+                        (username, loans_as_borrower, amount_borrowed, last_updated)
+                        VALUES ($3, 1, $4, now())
+                        ON CONFLICT (username) 
+                        DO UPDATE SET 
+                            loans_as_borrower = users.loans_as_borrower + 1,
+                            amount_borrowed = users.amount_borrowed + EXCLUDED.amount_borrowed,
+                            last_updated = EXCLUDED.last_updated
+                    )
+                    SELECT id FROM new_loan
+                ''', (
+                    loan_id,
+                    lender,
+                    borrower,
+                    amount,
+                    currency,
+                    thread_url,
+                ))
+                
+                db_id = cur.fetchone()[0]
+                
+                conn.commit()
+                logger.info("Confirmed loan: %s confirmed receiving %s %s from %s", borrower, amount, currency, lender)
+                
+                # Reply to the comment
+                reply_text = f'''
 Confirmed: u/{borrower} has confirmed receiving {amount:.2f} {currency} from u/{lender}.
 
 If you wish to mark this loan repaid later, you can use:
@@ -319,33 +494,25 @@ Processing time: {time.time() - comment.created_utc:.4f} seconds
 
 If the loan transaction did not work out and needs to be refunded then the *lender* should reply to this comment with 'Refunded' and moderators will be automatically notified
 '''
-        comment.reply(reply_text)
-        
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error processing confirm command: {e}")
-        logger.error(traceback.format_exc())  # Log full stack trace
-    finally:
-        cur.close()
-        conn.close()
+                send_reply(comment, reply_text)
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error("Error processing confirm command: %s", e)
+                logger.error(traceback.format_exc())  # Log full stack trace
 
 # Process $paid_with_id command
 # Process $paid_with_id command
 def process_paid_command(comment):
     # First, check if the command is in a code block and extract it
-    code_block_regex = r'```\s*(.*?)\s*```'
-    code_blocks = re.findall(code_block_regex, comment.body, re.DOTALL)
-    
-    # Text to search - either the code block content or the full comment body
-    text_to_search = code_blocks[0] if code_blocks else comment.body
+    text_to_search = extract_command_text(comment.body)
     
     # Now search for the paid command
-    paid_regex = r'\$paid_with_id\s+(\d+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})'
-    match = re.search(paid_regex, text_to_search, re.IGNORECASE)
+    match = PAID_RE.search(text_to_search)
     
     # If no match in code block or direct text, try the raw comment body again
-    if not match and code_blocks:
-        match = re.search(paid_regex, comment.body, re.IGNORECASE)
+    if not match and text_to_search != comment.body:
+        match = PAID_RE.search(comment.body)
     
     if not match:
         return
@@ -355,131 +522,111 @@ def process_paid_command(comment):
     amount_paid = Decimal(match.group(2))  # Convert to Decimal instead of float
     currency = match.group(3).upper()
     
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    try:
-        cur = conn.cursor()
-        
-        # Find the loan
-        cur.execute('''
-            SELECT id, borrower, amount, amount_repaid, currency, status
-            FROM loans
-            WHERE id = %s AND lender = %s
-        ''', (loan_id, lender))
-        
-        result = cur.fetchone()
-        if not result:
-            logger.warning(f"No matching loan found for payment: ID {loan_id} by {lender}")
-            comment.reply(f"Error: Could not find a loan with ID {loan_id} where you are the lender.")
-            return
-        
-        db_id, borrower, loan_amount, already_repaid, loan_currency, status = result
-        
-        # Check if this loan has already been fully repaid
-        if status == 'repaid':
-            comment.reply(f"Error: This loan (ID {loan_id}) has already been fully repaid.")
-            return
-        
-        # Ensure all values are Decimal for calculations
-        loan_amount = Decimal(loan_amount) if not isinstance(loan_amount, Decimal) else loan_amount
-        already_repaid = Decimal(already_repaid) if not isinstance(already_repaid, Decimal) else already_repaid
-        
-        if loan_currency != currency:
-            comment.reply(f"Error: Currency mismatch. The loan was in {loan_currency}, but you specified {currency}.")
+    with db_conn() as conn:
+        if not conn:
             return
         
-        # Get loan details before the update for the response
-        cur.execute('''
-            SELECT lender, borrower, amount, amount_repaid, currency, original_thread
-            FROM loans
-            WHERE id = %s
-        ''', (loan_id,))
-        loan_before = cur.fetchone()
-        
-        # Update the loan with the amount paid
-        new_repaid_amount = already_repaid + amount_paid
-        new_status = 'repaid' if new_repaid_amount >= loan_amount else 'partially_repaid'
-        
-        cur.execute('''
-            UPDATE loans
-            SET amount_repaid = %s,
-                status = %s,
-                last_updated = %s
-            WHERE id = %s
-        ''', (new_repaid_amount, new_status, datetime.now(), loan_id))
-        
-        # Update user statistics
-        cur.execute('''
-            UPDATE users
-            SET amount_repaid = amount_repaid + %s,
-                last_updated = %s
-            WHERE username = %s
-        ''', (amount_paid, datetime.now(), borrower))
-        
-        # Update unpaid loans count and amount if the loan is now fully paid
-        if new_status == 'repaid':
-            cur.execute('''
-                UPDATE users
-                SET unpaid_loans = GREATEST(unpaid_loans - 1, 0),
-                    unpaid_amount = GREATEST(unpaid_amount - %s, 0),
-                    last_updated = %s
-                WHERE username = %s
-            ''', (loan_amount, datetime.now(), borrower))
-        
-        # Get loan details after the update
-        cur.execute('''
-            SELECT lender, borrower, amount, amount_repaid, currency, original_thread
-            FROM loans
-            WHERE id = %s
-        ''', (loan_id,))
-        loan_after = cur.fetchone()
-        
-        conn.commit()
-        logger.info(f"Payment recorded: {borrower} repaid {amount_paid} {currency} to {lender}")
-        
-        # Generate the response message
-        response = f"u/{borrower} has now repaid u/{lender} {amount_paid:.2f} {currency}.\n\n"
-        response += "Loan before this transaction:\n\n"
-        response += "|Lender|Borrower|Amount Given|Amount Repaid|Unpaid?|Original Thread|\n"
-        response += "|---|---|---|---|---|---|\n"
-        response += f"|{loan_before[0]}|{loan_before[1]}|{loan_before[2]:.2f} {loan_before[4]}|{loan_before[3]:.2f} {loan_before[4]}|{'Yes' if loan_before[3] < loan_before[2] else 'No'}|[Link]({loan_before[5]})|\n\n"
-        
-        response += "Loan after this transaction:\n\n"
-        response += "|Lender|Borrower|Amount Given|Amount Repaid|Unpaid?|Original Thread|\n"
-        response += "|---|---|---|---|---|---|\n"
-        response += f"|{loan_after[0]}|{loan_after[1]}|{loan_after[2]:.2f} {loan_after[4]}|{loan_after[3]:.2f} {loan_after[4]}|{'Yes' if loan_after[3] < loan_after[2] else 'No'}|[Link]({loan_after[5]})|\n\n"
-        
-        remaining = loan_amount - new_repaid_amount
-        if remaining > 0:
-            response += f"amount specified: {amount_paid:.2f} {currency}, remaining: {remaining:.2f} {currency}"
-        else:
-            response += f"amount specified: {amount_paid:.2f} {currency}, remaining: 0.00 {currency}"
-        
-        comment.reply(response)
-        
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error processing paid command: {e}")
-        logger.error(traceback.format_exc())
-    finally:
-        cur.close()
-        conn.close()
+        with conn.cursor() as cur:
+            try:
+                # Apply the payment and update the borrower's statistics in one
+                # round trip. The new amount and status are computed by Postgres;
+                # the loan only matches if it belongs to the lender, is in the
+                # given currency and isn't fully repaid yet. Unpaid loans count and
+                # amount only drop if the loan is now fully paid.
+                execute_prepared(cur, 'record_payment', '''
+                    WITH loan_update AS (
+                        UPDATE loans
+                        SET amount_repaid = amount_repaid + $1,
+                            status = CASE WHEN amount_repaid + $1 >= amount
+                                THEN 'repaid' ELSE 'partially_repaid' END,
+                            last_updated = now()
+                        WHERE id = $2 AND lender = $3 AND currency = $4
+                            AND status IS DISTINCT FROM 'repaid'
+                        RETURNING lender, borrower, amount, amount_repaid, currency, original_thread, status
+                    ),
+                    user_update AS (
+                        UPDATE users
+                        SET amount_repaid = users.amount_repaid + $1,
+                            unpaid_loans = CASE WHEN loan_update.status = 'repaid'
+                                THEN GREATEST(users.unpaid_loans - 1, 0) ELSE users.unpaid_loans END,
+                            unpaid_amount = CASE WHEN loan_update.status = 'repaid'
+                                THEN GREATEST(users.unpaid_amount - loan_update.amount, 0) ELSE users.unpaid_amount END,
+                            last_updated = now()
+                        FROM loan_update
+                        WHERE users.username = loan_update.borrower
+                    )
+                    SELECT lender, borrower, amount, amount_repaid - $1, amount_repaid, currency, original_thread
+                    FROM loan_update
+                ''', (
+                    amount_paid,
+                    loan_id,
+                    lender,
+                    currency,
+                ))
+                
+                result = cur.fetchone()
+                if not result:
+                    # Nothing was updated; look the loan up to explain why
+                    cur.execute('''
+                        SELECT status, currency
+                        FROM loans
+                        WHERE id = %s AND lender = %s
+                    ''', (loan_id, lender))
+                    loan = cur.fetchone()
+                    if not loan:
+                        logger.warning("No matching loan found for payment: ID %s by %s", loan_id, lender)
+                        send_reply(comment, f"Error: Could not find a loan with ID {loan_id} where you are the lender.")
+                    elif loan[0] == 'repaid':
+                        send_reply(comment, f"Error: This loan (ID {loan_id}) has already been fully repaid.")
+                    else:
+                        send_reply(comment, f"Error: Currency mismatch. The loan was in {loan[1]}, but you specified {currency}.")
+                    return
+                
+                lender, borrower, loan_amount, already_repaid, new_repaid_amount, loan_currency, thread_url = result
+                loan_before = (lender, borrower, loan_amount, already_repaid, loan_currency, thread_url)
+                loan_after = (lender, borrower, loan_amount, new_repaid_amount, loan_currency, thread_url)
+                
+                conn.commit()
+                logger.info("Payment recorded: %s repaid %s %s to %s", borrower, amount_paid, currency, lender)
+                
+                # Generate the response message
+                response = f"u/{borrower} has now repaid u/{lender} {amount_paid:.2f} {currency}.\n\n"
+                response += "Loan before this transaction:\n\n"
+                response += "|Lender|Borrower|Amount Given|Amount Repaid|Unpaid?|Original Thread|\n"
+                response += "|---|---|---|---|---|---|\n"
+                response += f"|{loan_before[0]}|{loan_before[1]}|{loan_before[2]:.2f} {loan_before[4]}|{loan_before[3]:.2f} {loan_before[4]}|{'Yes' if loan_before[3] < loan_before[2] else 'No'}|[Link]({loan_before[5]})|\n\n"
+                
+                response += "Loan after this transaction:\n\n"
+                response += "|Lender|Borrower|Amount Given|Amount Repaid|Unpaid?|Original Thread|\n"
+                response += "|---|---|---|---|---|---|\n"
+                response += f"|{loan_after[0]}|{loan_after[1]}|{loan_after[2]:.2f} {loan_after[4]}|{loan_after[3]:.2f} {loan_after[4]}|{'Yes' if loan_after[3] < loan_after[2] else 'No'}|[Link]({loan_after[5]})|\n\n"
+                
+                remaining = loan_amount - new_repaid_amount
+                if remaining > 0:
+                    response += f"amount specified: {amount_paid:.2f} {currency}, remaining: {remaining:.2f} {currency}"
+                else:
+                    response += f"amount specified: {amount_paid:.2f} {currency}, remaining: 0.00 {currency}"
+                
+                send_reply(comment, response)
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error("Error processing paid command: %s", e)
+                logger.error(traceback.format_exc())
 
 # Process $refunded command
 def process_refund_command(comment):
-    # Check if this is a reply to a loan bot comment
-    if not comment.parent().author or comment.parent().author.name.lower() != os.getenv("REDDIT_USERNAME").lower():
+    # Cheap text check first; fetching the parent costs a Reddit API call
+    if not REFUNDED_RE.search(comment.body):
         return
     
-    if "refunded" not in comment.body.lower():
+    # Check if this is a reply to a loan bot comment
+    parent = comment.parent()
+    if not parent.author or parent.author.name not in BOT_NAMES:
         return
     
     # Extract the loan information from the parent comment
-    parent_body = comment.parent().body
-    loan_regex = r'u\/([^\s]+) has confirmed receiving (\d+(?:\.\d+)?)\s+([A-Z]{3}) from u\/([^\s\.]+)'
-    match = re.search(loan_regex, parent_body)
+    match = REFUND_RE.search(parent.body)
     
     if not match:
         return
@@ -491,87 +638,85 @@ def process_refund_command(comment):
     
     # Verify the refund command is from the lender
     if comment.author.name.lower() != lender:
-        comment.reply("Only the lender can mark a loan as refunded.")
-        return
-    
-    conn = get_db_connection()
-    if not conn:
+        send_reply(comment, "Only the lender can mark a loan as refunded.")
         return
     
-    try:
-        cur = conn.cursor()
-        
-        # Find the relevant loan
-        cur.execute('''
-            SELECT id FROM loans
-            WHERE lender = %s AND borrower = %s AND amount = %s AND currency = %s
-            ORDER BY date_created DESC
-            LIMIT 1
-        ''', (lender, borrower, amount, currency))
-        
-        result = cur.fetchone()
-        if not result:
-            logger.warning(f"No matching loan found for refund: {lender} to {borrower} for {amount} {currency}")
-            comment.reply(f"Error: Could not find a matching loan from you to u/{borrower} for {amount} {currency}.")
+    with db_conn() as conn:
+        if not conn:
             return
         
-        loan_id = result[0]
-
-        # Notify moderators - get the subreddit from the post
-        post_subreddit = comment.submission.subreddit.display_name
-        subreddit = reddit.subreddit(post_subreddit)
-        
-        # Update the loan status to refunded
-        cur.execute('''
-            UPDATE loans
-            SET status = 'refunded',
-                last_updated = %s
-            WHERE id = %s
-        ''', (datetime.now(), loan_id))
-        
-        # Update user statistics - properly update based on existing values
-        cur.execute('''
-            UPDATE users
-            SET loans_as_lender = GREATEST(loans_as_lender - 1, 0),
-                amount_lent = GREATEST(amount_lent - %s, 0),
-                last_updated = %s
-            WHERE username = %s
-        ''', (amount, datetime.now(), lender))
-        
-        cur.execute('''
-            UPDATE users
-            SET loans_as_borrower = GREATEST(loans_as_borrower - 1, 0),
-                amount_borrowed = GREATEST(amount_borrowed - %s, 0),
-                last_updated = %s
-            WHERE username = %s
-        ''', (amount, datetime.now(), borrower))
-        
-        conn.commit()
-        logger.info(f"Loan refunded: {lender} refunded {amount} {currency} to {borrower}")
-        
-        # Reply to the comment
-        comment.reply(f"Loan marked as refunded. The loan from u/{lender} to u/{borrower} for {amount:.2f} {currency} has been removed from both users' statistics.")
-        
-        # Notify moderators
-        subreddit = reddit.subreddit(os.getenv("SUBREDDIT"))
-        subject = f"Loan Refunded - {lender} to {borrower}"
-        message = f"A loan has been marked as refunded:\n\nLender: u/{lender}\nBorrower: u/{borrower}\nAmount: {amount:.2f} {currency}\n\nLink to comment: https://www.reddit.com{comment.permalink}"
-        subreddit.message(subject, message)
-        
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error processing refund command: {e}")
-        logger.error(traceback.format_exc())  # Log full stack trace
-    finally:
-        cur.close()
-        conn.close()
+        with conn.cursor() as cur:
+            try:
+                # Find the relevant loan, mark it refunded and update both users'
+                # statistics in one round trip. Nothing is updated if no loan matches.
+                execute_prepared(cur, 'refund_loan', '''
+                    WITH refunded AS (
+                        UPDATE loans
+                        SET status = 'refunded',
+                            last_updated = now()
+                        WHERE id = (
+                            SELECT id FROM loans
+                            WHERE lender = $1 AND borrower = $2
+                                AND amount = $3 AND currency = $4
+                            ORDER BY date_created DESC
+                            LIMIT 1
+                        )
+                        RETURNING id
+                    ),
+                    user_stats AS (
+                        UPDATE users
+                        SET loans_as_lender = CASE WHEN username = $1
+                                THEN GREATEST(loans_as_lender - 1, 0) ELSE loans_as_lender END,
+                            amount_lent = CASE WHEN username = $1
+                                THEN GREATEST(amount_lent - $3, 0) ELSE amount_lent END,
+                            loans_as_borrower = CASE WHEN username = $2
+                                THEN GREATEST(loans_as_borrower - 1, 0) ELSE loans_as_borrower END,
+                            amount_borrowed = CASE WHEN username = $2
+                                THEN GREATEST(amount_borrowed - $3, 0) ELSE amount_borrowed END,
+                            last_updated = now()
+                        WHERE username IN ($1, $2)
+                            AND EXISTS (SELECT 1 FROM refunded)
+                    )
+                    SELECT id FROM refunded
+                ''', (
+                    lender,
+                    borrower,
+                    amount,
+                    currency,
+                ))
+                
+                result = cur.fetchone()
+                if not result:
+                    logger.warning("No matching loan found for refund: %s to %s for %s %s", lender, borrower, amount, currency)
+                    send_reply(comment, f"Error: Could not find a matching loan from you to u/{borrower} for {amount} {currency}.")
+                    return
+                
+                # Notify moderators - get the subreddit from the post
+                post_subreddit = comment.submission.subreddit.display_name
+                subreddit = WORKER_REDDIT.subreddit(post_subreddit)
+                
+                conn.commit()
+                logger.info("Loan refunded: %s refunded %s %s to %s", lender, amount, currency, borrower)
+                
+                # Reply to the comment
+                send_reply(comment, f"Loan marked as refunded. The loan from u/{lender} to u/{borrower} for {amount:.2f} {currency} has been removed from both users' statistics.")
+                
+                # Notify moderators
+                subreddit = WORKER_REDDIT.subreddit(SUBREDDIT_NAME)
+                subject = f"Loan Refunded - {lender} to {borrower}"
+                message = f"A loan has been marked as refunded:\n\nLender: u/{lender}\nBorrower: u/{borrower}\nAmount: {amount:.2f} {currency}\n\nLink to comment: https://www.reddit.com{comment.permalink}"
+                subreddit.message(subject, message)
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error("Error processing refund command: %s", e)
+                logger.error(traceback.format_exc())  # Log full stack trace
 
 # Process $unpaid command
 # Process $unpaid command
 def process_unpaid_command(comment):
     # Check for command format
-    unpaid_regex = r'\$unpaid\s+(\d+)\s+u?\/?([\w-]+)'
-    match = re.search(unpaid_regex, comment.body, re.IGNORECASE)
+    match = UNPAID_RE.search(comment.body)
     
     if not match:
         return
@@ -580,302 +725,421 @@ def process_unpaid_command(comment):
     loan_id = match.group(1)
     borrower = match.group(2).lower()
     
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    try:
-        cur = conn.cursor()
-        
-        # Find the loan and verify the lender owns it
-        cur.execute('''
-            SELECT id, amount, currency, amount_repaid, original_thread, status
-            FROM loans
-            WHERE id = %s AND lender = %s AND borrower = %s
-        ''', (loan_id, lender, borrower))
-        
-        result = cur.fetchone()
-        if not result:
-            logger.warning(f"No matching loan found for unpaid: ID {loan_id} by {lender} for borrower {borrower}")
-            comment.reply(f"Error: Could not find a loan with ID {loan_id} where you are the lender and u/{borrower} is the borrower.")
+    with db_conn() as conn:
+        if not conn:
             return
         
-        db_id, loan_amount, loan_currency, amount_repaid, thread_url, status = result
+        with conn.cursor() as cur:
+            try:
+                # Find the loan and verify the lender owns it
+                cur.execute('''
+                    SELECT id, amount, currency, amount_repaid, original_thread, status
+                    FROM loans
+                    WHERE id = %s AND lender = %s AND borrower = %s
+                ''', (loan_id, lender, borrower))
+                
+                result = cur.fetchone()
+                if not result:
+                    logger.warning("No matching loan found for unpaid: ID %s by %s for borrower %s", loan_id, lender, borrower)
+                    send_reply(comment, f"Error: Could not find a loan with ID {loan_id} where you are the lender and u/{borrower} is the borrower.")
+                    return
+                
+                db_id, loan_amount, loan_currency, amount_repaid, thread_url, status = result
+                
+                # Ensure not already marked as unpaid
+                if status == 'unpaid':
+                    send_reply(comment, f"This loan has already been marked as unpaid.")
+                    return
+                
+                # Update the loan status to unpaid
+                cur.execute('''
+                    UPDATE loans
+                    SET status = 'unpaid',
+                        last_updated = now()
+                    WHERE id = %s
+                ''', (loan_id,))
+                
+                # Update user statistics - increment unpaid count for borrower
+                remaining_unpaid = loan_amount - amount_repaid
+                cur.execute('''
+                    UPDATE users
+                    SET unpaid_loans = unpaid_loans + 1,
+                        unpaid_amount = unpaid_amount + %s,
+                        last_updated = now()
+                    WHERE username = %s
+                ''', (remaining_unpaid, borrower))
+                
+                conn.commit()
+                logger.info("Loan marked as unpaid: Loan ID %s from %s to %s", loan_id, lender, borrower)
+                
+                # Create comprehensive response with details
+                response = f"u/{lender} has marked their loan to u/{borrower} as unpaid.\n\n"
+                response += "This loan has been recorded as unpaid in the database.\n\n"
+                response += "|Lender|Borrower|Amount|Amount Repaid|Date|Original Thread|\n"
+                response += "|:--:|:--:|:--:|:--:|:--:|:--:|\n"
+                response += f"|{lender}|{borrower}|{loan_amount:.2f} {loan_currency}|{amount_repaid:.2f} {loan_currency}|{datetime.now().strftime('%Y-%m-%d')}|[Link]({thread_url})|\n\n"
+                
+                # Add unpaid post link and notice about dispute
+                response += "If you would like to make a loan unpaid post, [use this link](https://www.reddit.com/r/borrow/submit?selftext=true&title=UNPAID:%20/u/"+borrower+"%20"+str(loan_amount)+"%20"+loan_currency+").\n\n"
+                response += "If this is in error, please contact the moderators."
+                
+                send_reply(comment, response)
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error("Error processing unpaid command: %s", e)
+                logger.error(traceback.format_exc())
+
+# Borrower repayment command
+# Borrower repayment command
+def process_repaid_command(comment):
+    # First, check if the command is in a code block and extract it
+    text_to_search = extract_command_text(comment.body)
+    
+    # Now search for the repaid command
+    m = REPAID_RE.search(text_to_search)
+    if not m: 
+        return
         
-        # Ensure not already marked as unpaid
-        if status == 'unpaid':
-            comment.reply(f"This loan has already been marked as unpaid.")
+    borrower = comment.author.name.lower()
+    loan_id = m.group(1)
+    repay_amt = Decimal(m.group(2))  # Use Decimal for financial calculations
+    currency = m.group(3).upper()
+    
+    with db_conn() as conn:
+        if not conn:
             return
         
-        # Update the loan status to unpaid
-        cur.execute('''
-            UPDATE loans
-            SET status = 'unpaid',
-                last_updated = %s
-            WHERE id = %s
-        ''', (datetime.now(), loan_id))
-        
-        # Update user statistics - increment unpaid count for borrower
-        remaining_unpaid = loan_amount - amount_repaid
-        cur.execute('''
-            UPDATE users
-            SET unpaid_loans = unpaid_loans + 1,
-                unpaid_amount = unpaid_amount + %s,
-                last_updated = %s
-            WHERE username = %s
-        ''', (remaining_unpaid, datetime.now(), borrower))
-        
-        conn.commit()
-        logger.info(f"Loan marked as unpaid: Loan ID {loan_id} from {lender} to {borrower}")
-        
-        # Create comprehensive response with details
-        response = f"u/{lender} has marked their loan to u/{borrower} as unpaid.\n\n"
-        response += "This loan has been recorded as unpaid in the database.\n\n"
-        response += "|Lender|Borrower|Amount|Amount Repaid|Date|Original Thread|\n"
-        response += "|:--:|:--:|:--:|:--:|:--:|:--:|\n"
-        response += f"|{lender}|{borrower}|{loan_amount:.2f} {loan_currency}|{amount_repaid:.2f} {loan_currency}|{datetime.now().strftime('%Y-%m-%d')}|[Link]({thread_url})|\n\n"
-        
-        # Add unpaid post link and notice about dispute
-        response += "If you would like to make a loan unpaid post, [use this link](https://www.reddit.com/r/borrow/submit?selftext=true&title=UNPAID:%20/u/"+borrower+"%20"+str(loan_amount)+"%20"+loan_currency+").\n\n"
-        response += "If this is in error, please contact the moderators."
-        
-        comment.reply(response)
-        
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error processing unpaid command: {e}")
-        logger.error(traceback.format_exc())
-    finally:
-        cur.close()
-        conn.close()
+        with conn.cursor() as cur:
+            try:
+                # Verify loan exists and borrower is correct
+                cur.execute('''
+                    SELECT lender, amount, amount_repaid, currency, status 
+                    FROM loans 
+                    WHERE id=%s AND borrower=%s
+                ''', (loan_id, borrower))
+                
+                res = cur.fetchone()
+                if not res:
+                    send_reply(comment, f"Error: No loan ID {loan_id} found where you are the borrower.")
+                    return
+                    
+                lender, total_amt, already_repaid, loan_currency, status = res
+                
+                # Check currency match
+                if currency != loan_currency:
+                    send_reply(comment, f"Error: Currency mismatch. The loan was in {loan_currency}, but you specified {currency}.")
+                    return
+                    
+                # Check if already fully repaid
+                if status == "repaid":
+                    send_reply(comment, "Error: This loan has already been fully repaid.")
+                    return
+                    
+                # Calculate new repayment amount and status
+                new_total = already_repaid + repay_amt
+                new_status = "repaid" if new_total >= total_amt else "partially_repaid"
+                remaining = max(total_amt - new_total, Decimal("0.00"))
+                
+                # Update loan record
+                cur.execute('''
+                    UPDATE loans 
+                    SET amount_repaid=%s, status=%s, last_updated=now() 
+                    WHERE id=%s
+                ''', (new_total, new_status, loan_id))
+                
+                # Update user stats
+                cur.execute('''
+                    UPDATE users 
+                    SET amount_repaid=amount_repaid+%s, last_updated=now() 
+                    WHERE username=%s
+                ''', (repay_amt, borrower))
+                
+                # If fully repaid, update unpaid counts
+                if new_status == "repaid":
+                    cur.execute('''
+                        UPDATE users 
+                        SET unpaid_loans=GREATEST(unpaid_loans-1,0), 
+                            unpaid_amount=GREATEST(unpaid_amount-%s,0), 
+                            last_updated=now() 
+                        WHERE username=%s
+                    ''', (total_amt, borrower))
+                
+                conn.commit()
+                
+                # Prepare response
+                response = f"u/{borrower} repaid {repay_amt:.2f} {currency} to u/{lender}.\n\n"
+                response += f"Payment of {repay_amt:.2f} {currency} recorded.\n\n"
+                response += "|Loan ID|Lender|Borrower|Original Amount|Amount Repaid|Remaining|\n"
+                response += "|:--:|:--:|:--:|:--:|:--:|:--:|\n"
+                response += f"|{loan_id}|{lender}|{borrower}|{total_amt:.2f} {currency}|{new_total:.2f} {currency}|{remaining:.2f} {currency}|\n\n"
+                
+                if remaining > 0:
+                    response += f"You still need to repay {remaining:.2f} {currency} to complete this loan."
+                else:
+                    response += "This loan has now been fully repaid! Thank you!"
+                
+                send_reply(comment, response)
+                logger.info("Repayment processed: %s repaid %.2f %s to %s", borrower, repay_amt, currency, lender)
+                
+            except Exception as e:
+                conn.rollback()
+                logger.error("Error processing repaid command: %s", e)
+                logger.error(traceback.format_exc())
 
         
 # ----- Account Stats Command -----
+# Reply layout for $stats; only the values change between requests
+STATS_TEMPLATE = """\
+**Account Statistics for u/{user}:**
+
+Comments Scanned: {total_comments} (Last 180 days: {recent_comments})
+Newest: {newest}
+Eldest: {eldest}
+
+**Unique Comment Activity:**
+Average Inactivity:
+All scanned: {avg_gap:.2f} day(s)
+Last 180 days: {avg_gap:.2f} day(s)
+
+Maximum Inactivity:
+All scanned: {max_gap:.0f} day(s)
+Last 180 days: {max_gap:.0f} day(s)
+
+**Daily Activity:**
+Average Inactivity:
+All scanned: {avg_day_gap:.2f} day(s)
+Last 180 days: {avg_day_gap:.2f} day(s)
+
+Maximum Inactivity:
+All scanned: {max_day_gap} day(s)
+Last 180 days: {max_day_gap} day(s)
+
+**Comment Karma From (Top 3):**{top_subs}
+
+**Account Globals:**
+Post Karma: {post_karma}
+Comment Karma: {comment_karma}
+Combined Karma: {combined}
+
+Account Age: {age_days} days ({age_years:.2f} years)
+Verified Email: {verified}
+USL Tags: None"""
+
+# Account info is cached per user for 5 minutes so repeated $stats requests
+# don't refetch /user/<name>/about/ from Reddit each time
+@cached(cache=TTLCache(maxsize=1024, ttl=300), lock=threading.Lock())
+def get_redditor_info(username):
+    redditor = WORKER_REDDIT.redditor(username)
+    # The first attribute access fetches the profile once; the rest are read from it
+    return {
+        'post_karma': redditor.link_karma,
+        'comment_karma': redditor.comment_karma,
+        'created_utc': redditor.created_utc,
+        'has_verified_email': getattr(redditor, 'has_verified_email', False),
+    }
+
 def process_stats_command(comment):
-    # Updated regex to make /u/ optional by using (?:/u/|u/) pattern
-    m = re.search(r"\$stats\s+(?:/u/|u/)([^\s]+)", comment.body, re.IGNORECASE)
+    m = STATS_RE.search(comment.body)
     if not m:
         return
     
     user = m.group(1).lower()
     
     try:
-        redditor = reddit.redditor(user)
+        redditor = WORKER_REDDIT.redditor(user)
         # Fetch comments (up to PRAW limit to avoid rate limits)
         comments = list(redditor.comments.new(limit=100))
         
         now = datetime.utcnow()
-        # Total and recent comments
+        # Total comments
         total_comments = len(comments)
-        cutoff = now - timedelta(days=180)
-        recent_comments = [c for c in comments if datetime.utcfromtimestamp(c.created_utc) >= cutoff]
         
         if not comments:
-            comment.reply(f"No comments found for u/{user}.")
+            send_reply(comment, f"No comments found for u/{user}.")
             return
-            
-        # Oldest & newest
-        dates = [datetime.utcfromtimestamp(c.created_utc) for c in comments]
-        newest = max(dates).date()
-        eldest = min(dates).date()
         
-        # Unique comment gaps
+        # Single pass over the comments, working on the raw created_utc
+        # timestamps: recent comments and karma by subreddit
+        dates = []
+        recent_comments = 0
+        cutoff_ts = time.time() - 180 * 86400
+        karma_map = Counter()
+        for c in comments:
+            ts = c.created_utc
+            dates.append(ts)
+            if ts >= cutoff_ts:
+                recent_comments += 1
+            karma_map[c.subreddit.display_name] += c.score
+        top_3 = heapq.nlargest(3, karma_map.items(), key=lambda x: x[1])
+            
+        # Sort once; oldest & newest are the ends of the sorted list
         sorted_dates = sorted(dates)
-        gaps = [(t2 - t1).total_seconds() for t1, t2 in zip(sorted_dates, sorted_dates[1:])]
+        newest = datetime.utcfromtimestamp(sorted_dates[-1]).date()
+        eldest = datetime.utcfromtimestamp(sorted_dates[0]).date()
+        
+        # Unique comment gaps (in seconds)
+        gaps = [t2 - t1 for t1, t2 in zip(sorted_dates, sorted_dates[1:])]
         avg_gap = sum(gaps) / len(gaps) / 86400 if gaps else 0
         max_gap = max(gaps) / 86400 if gaps else 0
         
-        # Daily activity
-        days = sorted(list({dt.date() for dt in dates}))
-        day_gaps = [(t2 - t1).days for t1, t2 in zip(days, days[1:])]
+        # Daily activity, using days since the epoch (UTC) as the day key.
+        # The days come out in order, so skipping same-day neighbours gives the
+        # gaps between distinct active days without another set + sort.
+        days = [int(ts // 86400) for ts in sorted_dates]
+        day_gaps = [t2 - t1 for t1, t2 in zip(days, days[1:]) if t2 != t1]
         avg_day_gap = sum(day_gaps) / len(day_gaps) if day_gaps else 0
         max_day_gap = max(day_gaps) if day_gaps else 0
         
-        # Karma by subreddit
-        karma_map = {}
-        for c in comments:
-            sr = c.subreddit.display_name
-            karma_map[sr] = karma_map.get(sr, 0) + c.score
-        top_3 = sorted(karma_map.items(), key=lambda x: x[1], reverse=True)[:3]
-        
         # Account info
-        post_karma = redditor.link_karma
-        comment_karma = redditor.comment_karma
+        info = get_redditor_info(user)
+        post_karma = info['post_karma']
+        comment_karma = info['comment_karma']
         combined = post_karma + comment_karma
-        created = datetime.utcfromtimestamp(redditor.created_utc)
+        created = datetime.utcfromtimestamp(info['created_utc'])
         age_days = (now - created).days
         age_years = age_days / 365
-        verified = getattr(redditor, 'has_verified_email', False)
+        verified = info['has_verified_email']
         
         # Build reply
-        reply = [f"**Account Statistics for u/{user}:**\n"]
-        reply.append(f"Comments Scanned: {total_comments} (Last 180 days: {len(recent_comments)})")
-        reply.append(f"Newest: {newest}")
-        reply.append(f"Eldest: {eldest}\n")
-        reply.append("**Unique Comment Activity:**")
-        reply.append("Average Inactivity:")
-        reply.append(f"All scanned: {avg_gap:.2f} day(s)")
-        reply.append(f"Last 180 days: {avg_gap:.2f} day(s)\n")
-        reply.append("Maximum Inactivity:")
-        reply.append(f"All scanned: {max_gap:.0f} day(s)")
-        reply.append(f"Last 180 days: {max_gap:.0f} day(s)\n")
-        reply.append("**Daily Activity:**")
-        reply.append("Average Inactivity:")
-        reply.append(f"All scanned: {avg_day_gap:.2f} day(s)")
-        reply.append(f"Last 180 days: {avg_day_gap:.2f} day(s)\n")
-        reply.append("Maximum Inactivity:")
-        reply.append(f"All scanned: {max_day_gap} day(s)")
-        reply.append(f"Last 180 days: {max_day_gap} day(s)\n")
-        reply.append("**Comment Karma From (Top 3):**")
-        for sr, k in top_3:
-            reply.append(f"r/{sr}: {k}")
-        reply.append("\n**Account Globals:**")
-        reply.append(f"Post Karma: {post_karma}")
-        reply.append(f"Comment Karma: {comment_karma}")
-        reply.append(f"Combined Karma: {combined}\n")
-        reply.append(f"Account Age: {age_days} days ({age_years:.2f} years)")
-        reply.append(f"Verified Email: {'Yes' if verified else 'No'}")
-        reply.append(f"USL Tags: None")
+        reply = STATS_TEMPLATE.format_map({
+            'user': user,
+            'total_comments': total_comments,
+            'recent_comments': recent_comments,
+            'newest': newest,
+            'eldest': eldest,
+            'avg_gap': avg_gap,
+            'max_gap': max_gap,
+            'avg_day_gap': avg_day_gap,
+            'max_day_gap': max_day_gap,
+            'top_subs': "".join(f"\nr/{sr}: {k}" for sr, k in top_3),
+            'post_karma': post_karma,
+            'comment_karma': comment_karma,
+            'combined': combined,
+            'age_days': age_days,
+            'age_years': age_years,
+            'verified': 'Yes' if verified else 'No',
+        })
         
         # Send reply
-        comment.reply("\n".join(reply))
-        logger.info(f"Stats sent for u/{user}")
+        send_reply(comment, reply)
+        logger.info("Stats sent for u/%s", user)
     except Exception as e:
-        logger.error(f"Error processing stats for u/{user}: {e}")
+        logger.error("Error processing stats for u/%s: %s", user, e)
         logger.error(traceback.format_exc())  # Added consistent error logging
-        try:
-            comment.reply(f"Error fetching stats for u/{user}.")
-        except:
-            pass
+        send_reply(comment, f"Error fetching stats for u/{user}.")
 
 # Generate user information for posts
 def generate_user_info(username):
-    conn = get_db_connection()
-    if not conn:
-        return "Could not retrieve user information due to database error."
-    
-    try:
-        cur = conn.cursor()
-        
-        # Get user statistics
-        cur.execute('''
-            SELECT 
-                COALESCE(loans_as_borrower, 0) as loans_as_borrower,
-                COALESCE(amount_borrowed, 0) as amount_borrowed,
-                COALESCE(loans_as_lender, 0) as loans_as_lender,
-                COALESCE(amount_lent, 0) as amount_lent,
-                COALESCE(amount_repaid, 0) as amount_repaid,
-                COALESCE(unpaid_loans, 0) as unpaid_loans,
-                COALESCE(unpaid_amount, 0) as unpaid_amount
-            FROM users
-            WHERE username = %s
-        ''', (username.lower(),))
-        
-        user_stats = cur.fetchone()
-        if not user_stats:
-            return f"Here is my information on u/{username}:\n\nThis user has no loan history."
-        
-        loans_as_borrower, amount_borrowed, loans_as_lender, amount_lent, amount_repaid, unpaid_loans, unpaid_amount = user_stats
-        
-        # Check for unpaid loans where user is borrower
-        cur.execute('''
-            SELECT COUNT(*) as count
-            FROM loans
-            WHERE borrower = %s AND (status = 'active' OR status = 'confirmed' OR status = 'partially_repaid')
-        ''', (username.lower(),))
-        current_unpaid_as_borrower = cur.fetchone()[0]
-        
-        # Get unpaid loans where user is lender
-        cur.execute('''
-            SELECT id, borrower, amount, amount_repaid, currency, original_thread
-            FROM loans
-            WHERE lender = %s AND (status = 'active' OR status = 'confirmed' OR status = 'partially_repaid')
-            ORDER BY date_created DESC
-            LIMIT 5
-        ''', (username.lower(),))
-        unpaid_loans_as_lender = cur.fetchall()
-        
-        # Get in-progress loans where user is lender
-        cur.execute('''
-            SELECT COUNT(*) as count, SUM(amount - amount_repaid) as total
-            FROM loans
-            WHERE lender = %s AND (status = 'active' OR status = 'confirmed' OR status = 'partially_repaid')
-        ''', (username.lower(),))
-        in_progress_count_total = cur.fetchone()
-        in_progress_count = in_progress_count_total[0] if in_progress_count_total[0] else 0
-        in_progress_total = in_progress_count_total[1] if in_progress_count_total[1] else 0
-        
-        # Get in-progress loans where user is lender (for display)
-        cur.execute('''
-            SELECT id, borrower, amount, amount_repaid, currency, original_thread
-            FROM loans
-            WHERE lender = %s AND (status = 'active' OR status = 'confirmed' OR status = 'partially_repaid')
-            ORDER BY date_created DESC
-            LIMIT 5
-        ''', (username.lower(),))
-        in_progress_loans = cur.fetchall()
-        
-        # Build the response
-        response = f"Here is my information on u/{username}:\n\n"
-        response += f"**Mobile View**\n\n"
-        response += f"u/{username} has {loans_as_borrower} loans paid as a borrower, for a total of ${amount_borrowed:.2f}\n\n"
-        response += f"u/{username} has {loans_as_lender} loans paid as a lender, for a total of ${amount_lent:.2f}\n\n"
+    with db_conn() as conn:
+        if not conn:
+            return "Could not retrieve user information due to database error."
+        
+        with conn.cursor() as cur:
+            try:
+                # Get user statistics together with the number of unpaid loans
+                # where the user is the borrower
+                execute_prepared(cur, 'user_info_stats', '''
+                    SELECT 
+                        COALESCE(loans_as_borrower, 0) as loans_as_borrower,
+                        COALESCE(amount_borrowed, 0) as amount_borrowed,
+                        COALESCE(loans_as_lender, 0) as loans_as_lender,
+                        COALESCE(amount_lent, 0) as amount_lent,
+                        COALESCE(amount_repaid, 0) as amount_repaid,
+                        COALESCE(unpaid_loans, 0) as unpaid_loans,
+                        COALESCE(unpaid_amount, 0) as unpaid_amount,
+                        unpaid_as_borrower.count
+                    FROM users
+                    LEFT JOIN (
+                        SELECT COUNT(*) as count
+                        FROM loans
+                        WHERE borrower = $1 AND status IN ('active', 'confirmed', 'partially_repaid')
+                    ) unpaid_as_borrower ON true
+                    WHERE username = $1
+                ''', (username.lower(),))
+                
+                user_stats = cur.fetchone()
+                if not user_stats:
+                    return f"Here is my information on u/{username}:\n\nThis user has no loan history."
+                
+                loans_as_borrower, amount_borrowed, loans_as_lender, amount_lent, amount_repaid, unpaid_loans, unpaid_amount, current_unpaid_as_borrower = user_stats
+                
+                # Get the latest in-progress loans where user is lender, plus the
+                # count and outstanding total over all of them (window aggregates
+                # are computed before the LIMIT)
+                execute_prepared(cur, 'user_info_lender_loans', '''
+                    SELECT id, borrower, amount, amount_repaid, currency, original_thread,
+                        COUNT(*) OVER () as count,
+                        SUM(amount - amount_repaid) OVER () as total
+                    FROM loans
+                    WHERE lender = $1 AND status IN ('active', 'confirmed', 'partially_repaid')
+                    ORDER BY date_created DESC
+                    LIMIT 5
+                ''', (username.lower(),))
+                rows = cur.fetchall()
+                in_progress_loans = [row[:6] for row in rows]
+                unpaid_loans_as_lender = in_progress_loans
+                in_progress_count = rows[0][6] if rows else 0
+                in_progress_total = rows[0][7] if rows and rows[0][7] else 0
+                
+                # Build the response
+                response = f"Here is my information on u/{username}:\n\n"
+                response += f"**Mobile View**\n\n"
+                response += f"u/{username} has {loans_as_borrower} loans paid as a borrower, for a total of ${amount_borrowed:.2f}\n\n"
+                response += f"u/{username} has {loans_as_lender} loans paid as a lender, for a total of ${amount_lent:.2f}\n\n"
 
-        
-        
-        if current_unpaid_as_borrower == 0:
-            response += f"u/{username} has not received any loans which are currently marked unpaid\n\n"
-        
-        else:
-            response += f"u/{username} has {current_unpaid_as_borrower} current unpaid loans as borrower\n\n"
-        
-        # Show unpaid loans as lender if any
-        if unpaid_loans_as_lender:
-            total_unpaid = sum(loan[2] - loan[3] for loan in unpaid_loans_as_lender)
-            omitted_count = in_progress_count - len(unpaid_loans_as_lender) if in_progress_count > len(unpaid_loans_as_lender) else 0
-            
-            response += f"Loans unpaid with u/{username} as lender ({len(unpaid_loans_as_lender)} loans, ${total_unpaid:.2f}) "
-            if omitted_count > 0:
-                response += f"({omitted_count} loans omitted from the table):\n\n"
-            else:
-                response += ":\n\n"
-            
-            response += "Lender | Borrower | Amount Given | Amount Repaid | Unpaid? | Original Thread\n"
-            response += "--- | --- | --- | --- | --- | ---\n"
-            
-            for loan in unpaid_loans_as_lender:
-                db_id, borrower, amount, amount_repaid, currency, thread = loan
-                response += f"{username.lower()} | {borrower} | {amount:.2f} {currency} | {amount_repaid:.2f} {currency} | UNPAID | {thread}\n"
-        
-        # Show that user doesn't have outstanding loans as a borrower
-        response += f"\nu/{username} does not have any outstanding loans as a borrower\n\n"
-        
-        # Show in-progress loans as lender if any
-        if in_progress_loans:
-            omitted_count = in_progress_count - len(in_progress_loans) if in_progress_count > len(in_progress_loans) else 0
-            
-            response += f"In-progress loans with u/{username} as lender ({in_progress_count} loans, ${in_progress_total:.2f}) "
-            if omitted_count > 0:
-                response += f"({omitted_count} loans omitted from the table):\n\n"
-            else:
-                response += ":\n\n"
-            
-            response += "Lender | Borrower | Amount Given | Amount Repaid | Unpaid? | Original Thread\n"
-            response += "--- | --- | --- | --- | --- | ---\n"
-            
-            for loan in in_progress_loans:
-                db_id, borrower, amount, amount_repaid, currency, thread = loan
-                response += f"{username.lower()} | {borrower} | {amount:.2f} {currency} | {amount_repaid:.2f} {currency} | {'Yes' if amount_repaid < amount else 'No'} | {thread}\n"
-        
-        return response
-        
-    except Exception as e:
-        logger.error(f"Error generating user info: {e}")
-        logger.error(traceback.format_exc())  # Log full stack trace
-        return f"Could not retrieve user information due to an error: {str(e)}"
-    finally:
-        cur.close()
-        conn.close()
+                
+                
+                if current_unpaid_as_borrower == 0:
+                    response += f"u/{username} has not received any loans which are currently marked unpaid\n\n"
+                
+                else:
+                    response += f"u/{username} has {current_unpaid_as_borrower} current unpaid loans as borrower\n\n"
+                
+                # Show unpaid loans as lender if any
+                if unpaid_loans_as_lender:
+                    total_unpaid = sum(loan[2] - loan[3] for loan in unpaid_loans_as_lender)
+                    omitted_count = in_progress_count - len(unpaid_loans_as_lender) if in_progress_count > len(unpaid_loans_as_lender) else 0
+                    
+                    response += f"Loans unpaid with u/{username} as lender ({len(unpaid_loans_as_lender)} loans, ${total_unpaid:.2f}) "
+                    if omitted_count > 0:
+                        response += f"({omitted_count} loans omitted from the table):\n\n"
+                    else:
+                        response += ":\n\n"
+                    
+                    response += "Lender | Borrower | Amount Given | Amount Repaid | Unpaid? | Original Thread\n"
+                    response += "--- | --- | --- | --- | --- | ---\n"
+                    
+                    for loan in unpaid_loans_as_lender:
+                        db_id, borrower, amount, amount_repaid, currency, thread = loan
+                        response += f"{username.lower()} | {borrower} | {amount:.2f} {currency} | {amount_repaid:.2f} {currency} | UNPAID | {thread}\n"
+                
+                # Show that user doesn't have outstanding loans as a borrower
+                response += f"\nu/{username} does not have any outstanding loans as a borrower\n\n"
+                
+                # Show in-progress loans as lender if any
+                if in_progress_loans:
+                    omitted_count = in_progress_count - len(in_progress_loans) if in_progress_count > len(in_progress_loans) else 0
+                    
+                    response += f"In-progress loans with u/{username} as lender ({in_progress_count} loans, ${in_progress_total:.2f}) "
+                    if omitted_count > 0:
+                        response += f"({omitted_count} loans omitted from the table):\n\n"
+                    else:
+                        response += ":\n\n"
+                    
+                    response += "Lender | Borrower | Amount Given | Amount Repaid | Unpaid? | Original Thread\n"
+                    response += "--- | --- | --- | --- | --- | ---\n"
+                    
+                    for loan in in_progress_loans:
+                        db_id, borrower, amount, amount_repaid, currency, thread = loan
+                        response += f"{username.lower()} | {borrower} | {amount:.2f} {currency} | {amount_repaid:.2f} {currency} | {'Yes' if amount_repaid < amount else 'No'} | {thread}\n"
+                
+                return response
+                
+            except Exception as e:
+                logger.error("Error generating user info: %s", e)
+                logger.error(traceback.format_exc())  # Log full stack trace
+                return f"Could not retrieve user information due to an error: {str(e)}"
 
 # Handle new posts
 def handle_new_post(post):
@@ -885,187 +1149,240 @@ def handle_new_post(post):
     username = post.author.name
     user_info = generate_user_info(username)
     
-    try:
-        post.reply(user_info)
-        logger.info(f"Posted user information for {username}")
-    except Exception as e:
-        logger.error(f"Error posting user info: {e}")
-        logger.error(traceback.format_exc())  # Log full stack trace
+    send_reply(post, user_info)
+    logger.info("Posted user information for %s", username)
 
-# Function to keep the bot alive
-def keep_alive():
-    while True:
-        try:
-            logger.info("Keep-alive heartbeat")
-            time.sleep(300)  # 5-minute heartbeat
-        except Exception as e:
-            logger.error(f"Error in keep_alive: {e}")
-            logger.error(traceback.format_exc())  # Log full stack trace
+# SIGTERM (sent on restarts and deploys) unwinds the main thread like Ctrl+C
+def handle_shutdown(signum, frame):
+    logger.info("Received signal %s, shutting down", signum)
+    raise SystemExit(0)
+
+# Command token (lowercase) -> handler; adding a command is one entry here.
+# Order is priority: when a comment holds several tokens the earliest entry
+# wins wherever it appears, so prose like "refunded the fee" can't take over
+# a real $paid_with_id. Matching is separate: COMMAND_RE tries longer tokens
+# first, so a token that prefixes another (a future "$paid" next to
+# "$paid_with_id") can't shadow it
+HANDLERS = {
+    "$loan": process_loan_command,
+    "$confirm": process_confirm_command,
+    "$paid_with_id": process_paid_command,
+    "refunded": process_refund_command,
+    "$stats": process_stats_command,
+    "$unpaid": process_unpaid_command,
+    "$repaid": process_repaid_command,
+}
+# re takes the first alternative that matches at a position, hence longest first
+COMMAND_TOKENS = sorted(HANDLERS, key=len, reverse=True)
+# All tokens in one case-insensitive alternation, so a single scan of the raw
+# body finds every command; each token is a named group
+COMMAND_RE = re.compile(
+    "|".join(f"(?P<c{i}>{re.escape(token)})" for i, token in enumerate(COMMAND_TOKENS)),
+    re.IGNORECASE,
+)
+# Group name -> (priority, handler). The keys are the compiled pattern's own
+# name strings, the same objects match.lastgroup returns, so dispatch is an
+# identity hit in the dict and never copies or lowercases the matched text
+COMMAND_PRIORITY = {token: rank for rank, token in enumerate(HANDLERS)}
+GROUP_HANDLERS = {
+    name: (COMMAND_PRIORITY[COMMAND_TOKENS[index - 1]], HANDLERS[COMMAND_TOKENS[index - 1]])
+    for name, index in COMMAND_RE.groupindex.items()
+}
+
+# Seconds to wait before polling again when neither stream had anything new:
+# doubles per consecutive empty round up to the cap, like PRAW's own stream
+# backoff (which pause_after=0 bypasses), and drops back once items arrive
+STREAM_IDLE_MIN_DELAY = 1
+STREAM_IDLE_MAX_DELAY = 16
+# Seconds between keep-alive heartbeats logged by the stream loop
+HEARTBEAT_INTERVAL = 300
+# Reconnect backoff in seconds: doubles per consecutive failure up to the cap,
+# starting higher when Reddit itself answered with an error (rate limit, outage)
+RECONNECT_MIN_DELAY = 1
+RECONNECT_RESPONSE_DELAY = 30
+RECONNECT_MAX_DELAY = 120
+
+# (handler, comment or post) pairs waiting for the command worker, the items
+# rebound to WORKER_REDDIT. Bounded, so a backlog of slow commands holds up the
+# stream instead of growing unchecked
+WORK_QUEUE = queue.Queue(maxsize=100)
 
-# Main bot loop with error handling and reconnection
-def comment_monitor():
+# Runs queued handlers off the stream thread, so database and Reddit round
+# trips don't delay the next poll. A single worker keeps commands in the order
+# they were posted (a $confirm before the $paid_with_id for the same loan).
+# Database writes are committed per command rather than batched: each reply
+# needs the row its command just wrote (the new loan id, the RETURNING
+# snapshot), so a write can't be deferred. Each command already costs a
+# single round trip on a pooled connection.
+def command_worker():
     while True:
+        item = WORK_QUEUE.get()
+        if item is None:  # Shutdown sentinel
+            return
+        
+        handler, target = item
         try:
-            subreddit = reddit.subreddit(subreddit_str)
-            
-            logger.info(f"Starting comment stream for subreddits: {subreddit_str}")
-            for comment in subreddit.stream.comments(skip_existing=True):
-                if comment.author is None or comment.author.name.lower() == os.getenv("REDDIT_USERNAME").lower():
-                    continue
-                
-                body_lower = comment.body.lower()
-                
-                if "$loan" in body_lower:
-                    process_loan_command(comment)
-                elif "$confirm" in body_lower:
-                    process_confirm_command(comment)
-                elif "$paid_with_id" in body_lower:
-                    process_paid_command(comment)
-                elif "refunded" in body_lower:
-                    process_refund_command(comment)
-                elif "$stats" in body_lower:
-                    process_stats_command(comment)
-                elif "$unpaid" in body_lower:
-                    process_unpaid_command(comment)
-                elif "$repaid" in body_lower:
-                    process_repaid_command(comment)
-                 
-                    
+            handler(target)
         except Exception as e:
-            logger.error(f"Error in comment stream: {e}")
+            logger.error("Error in command worker: %s", e)
             logger.error(traceback.format_exc())  # Log full stack trace
-            logger.info("Reconnecting in 60 seconds...")
-            time.sleep(60)  # Wait 60 seconds before reconnecting
 
-# Post monitor with error handling and reconnection
-def post_monitor():
-    while True:
+# Handle one comment from the stream
+def handle_comment(comment):
+    if comment.author is None or comment.author.name in BOT_NAMES:
+        return
+    
+    # Fast reject for the many comments with no command at all: every token
+    # but "refunded" starts with "$", and refund replies are written in one
+    # of these casings
+    body = comment.body
+    if "$" not in body and "refund" not in body and "Refund" not in body and "REFUND" not in body:
+        return
+    
+    # Find every command token in one pass and pick the highest-priority one,
+    # so a handler (and its regex) only runs for comments containing its command
+    best = min((GROUP_HANDLERS[match.lastgroup] for match in COMMAND_RE.finditer(body)), default=None)
+    if best:
+        WORK_QUEUE.put((best[1], rebind(comment, WORKER_REDDIT)))
+
+# Queue [REQ] posts for the user summary reply
+def handle_post(post):
+    if REQ_TITLE_RE.search(post.title):
+        WORK_QUEUE.put((handle_new_post, rebind(post, WORKER_REDDIT)))
+
+# One PRAW stream with its own reconnect backoff. With pause_after=0 the stream
+# yields None as soon as a poll comes back empty, so several can share a thread;
+# a failing stream is recreated on its own and never restarts the others
+class MonitoredStream:
+    def __init__(self, name, open_stream, handle):
+        self.name = name
+        self.open_stream = open_stream
+        self.handle = handle
+        self.items = None
+        self.started = 0
+        self.retry_at = 0
+        self.delay = RECONNECT_MIN_DELAY
+
+    # Handle everything new on the stream; returns True if anything arrived
+    def poll(self):
+        arrived = False
         try:
-            subreddit = reddit.subreddit(os.getenv("SUBREDDIT"))
+            if self.items is None:
+                if time.monotonic() < self.retry_at:
+                    return False
+                logger.info("Starting %s stream", self.name)
+                self.started = time.monotonic()
+                self.items = self.open_stream()
             
-            logger.info("Starting post stream")
-            for post in subreddit.stream.submissions(skip_existing=True):
-                # Only process [REQ] posts
-                if "[req]" in post.title.lower():
-                    handle_new_post(post)
-                    
+            for item in self.items:
+                if item is None:
+                    break
+                arrived = True
+                self.handle(item)
         except Exception as e:
-            logger.error(f"Error in post stream: {e}")
-            logger.error(traceback.format_exc())  # Log full stack trace
-            logger.info("Reconnecting in 60 seconds...")
-            time.sleep(60)  # Wait 60 seconds before reconnecting
+            self.fail(e)
+        return arrived
 
+    # Drop the stream and schedule its reconnect
+    def fail(self, e):
+        self.items = None
+        if isinstance(e, (prawcore.exceptions.RequestException, prawcore.exceptions.ServerError)):
+            # Routine network drops and Reddit outages; a traceback adds nothing
+            logger.warning("%s stream disconnected: %r", self.name, e)
+        else:
+            logger.exception("Error in %s stream: %s", self.name, e)
+        
+        # A minute of clean streaming means this failure starts a new run
+        if time.monotonic() - self.started >= 60:
+            self.delay = RECONNECT_MIN_DELAY
+        if isinstance(e, prawcore.exceptions.ResponseException):
+            self.delay = max(self.delay, RECONNECT_RESPONSE_DELAY)
+        
+        # Jitter so repeated failures don't reconnect in lockstep
+        wait = self.delay * (0.5 + random.random())
+        logger.info("Reconnecting %s stream in %.0f seconds...", self.name, wait)
+        self.retry_at = time.monotonic() + wait
+        self.delay = min(self.delay * 2, RECONNECT_MAX_DELAY)
 
-# Borrower repayment command
-# Borrower repayment command
-def process_repaid_command(comment):
-    # First, check if the command is in a code block and extract it
-    code_block_regex = r'```\s*(.*?)\s*```'
-    code_blocks = re.findall(code_block_regex, comment.body, re.DOTALL)
+# Main bot loop: comments and [REQ] posts are streamed on this one thread
+def stream_monitor():
+    # Subreddit handles are lazy and safe to reuse; only the streams are
+    # recreated after an error
+    comment_subreddit = reddit.subreddit(subreddit_str)
     
-    # Text to search - either the code block content or the full comment body
-    text_to_search = code_blocks[0] if code_blocks else comment.body
+    def open_comment_stream():
+        BOT_NAMES.add(reddit.user.me().name)
+        return comment_subreddit.stream.comments(skip_existing=True, pause_after=0)
     
-    # Now search for the repaid command
-    m = re.search(r"\$repaid\s+(\d+)\s+(\d+(?:\.\d+)?)\s+([A-Z]{3})", text_to_search, re.IGNORECASE)
-    if not m: 
-        return
-        
-    borrower = comment.author.name.lower()
-    loan_id = m.group(1)
-    repay_amt = Decimal(m.group(2))  # Use Decimal for financial calculations
-    currency = m.group(3).upper()
+    streams = [MonitoredStream(f"comment ({subreddit_str})", open_comment_stream, handle_comment)]
     
-    conn = get_db_connection()
-    if not conn:
-        return
-        
-    try:
-        cur = conn.cursor()
-        
-        # Verify loan exists and borrower is correct
-        cur.execute('''
-            SELECT lender, amount, amount_repaid, currency, status 
-            FROM loans 
-            WHERE id=%s AND borrower=%s
-        ''', (loan_id, borrower))
-        
-        res = cur.fetchone()
-        if not res:
-            comment.reply(f"Error: No loan ID {loan_id} found where you are the borrower.")
-            return
-            
-        lender, total_amt, already_repaid, loan_currency, status = res
-        
-        # Check currency match
-        if currency != loan_currency:
-            comment.reply(f"Error: Currency mismatch. The loan was in {loan_currency}, but you specified {currency}.")
-            return
-            
-        # Check if already fully repaid
-        if status == "repaid":
-            comment.reply("Error: This loan has already been fully repaid.")
-            return
-            
-        # Calculate new repayment amount and status
-        new_total = already_repaid + repay_amt
-        new_status = "repaid" if new_total >= total_amt else "partially_repaid"
-        remaining = max(total_amt - new_total, Decimal("0.00"))
-        
-        # Update loan record
-        cur.execute('''
-            UPDATE loans 
-            SET amount_repaid=%s, status=%s, last_updated=%s 
-            WHERE id=%s
-        ''', (new_total, new_status, datetime.now(), loan_id))
-        
-        # Update user stats
-        cur.execute('''
-            UPDATE users 
-            SET amount_repaid=amount_repaid+%s, last_updated=%s 
-            WHERE username=%s
-        ''', (repay_amt, datetime.now(), borrower))
-        
-        # If fully repaid, update unpaid counts
-        if new_status == "repaid":
-            cur.execute('''
-                UPDATE users 
-                SET unpaid_loans=GREATEST(unpaid_loans-1,0), 
-                    unpaid_amount=GREATEST(unpaid_amount-%s,0), 
-                    last_updated=%s 
-                WHERE username=%s
-            ''', (total_amt, datetime.now(), borrower))
-        
-        conn.commit()
-        
-        # Prepare response
-        response = f"u/{borrower} repaid {repay_amt:.2f} {currency} to u/{lender}.\n\n"
-        response += f"Payment of {repay_amt:.2f} {currency} recorded.\n\n"
-        response += "|Loan ID|Lender|Borrower|Original Amount|Amount Repaid|Remaining|\n"
-        response += "|:--:|:--:|:--:|:--:|:--:|:--:|\n"
-        response += f"|{loan_id}|{lender}|{borrower}|{total_amt:.2f} {currency}|{new_total:.2f} {currency}|{remaining:.2f} {currency}|\n\n"
+    # [REQ] posts are only read from the home subreddit; a config with just
+    # SUBREDDITS runs the comment stream alone
+    if SUBREDDIT_NAME:
+        post_subreddit = reddit.subreddit(SUBREDDIT_NAME)
+        
+        def open_post_stream():
+            return post_subreddit.stream.submissions(skip_existing=True, pause_after=0)
+        
+        streams.append(MonitoredStream("post", open_post_stream, handle_post))
+    else:
+        logger.warning("SUBREDDIT not set, not monitoring [REQ] posts")
+    idle_delay = STREAM_IDLE_MIN_DELAY
+    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+    
+    while True:
+        idle = True
+        for stream in streams:
+            if stream.poll():
+                idle = False
+        
+        # Logged from the stream loop itself, so a stalled loop also stops
+        # the heartbeat
+        if time.monotonic() >= next_heartbeat:
+            logger.info("Keep-alive heartbeat")
+            next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
         
-        if remaining > 0:
-            response += f"You still need to repay {remaining:.2f} {currency} to complete this loan."
+        if idle:
+            time.sleep(idle_delay)
+            idle_delay = min(idle_delay * 2, STREAM_IDLE_MAX_DELAY)
         else:
-            response += "This loan has now been fully repaid! Thank you!"
-        
-        comment.reply(response)
-        logger.info(f"Repayment processed: {borrower} repaid {repay_amt:.2f} {currency} to {lender}")
-        
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error processing repaid command: {e}")
-        logger.error(traceback.format_exc())
-    finally:
-        cur.close()
-        conn.close()
+            idle_delay = STREAM_IDLE_MIN_DELAY
+
 
 if __name__ == "__main__":
-    if not init_database():
+    if not init_db_pool() or not init_database():
         sys.exit("Failed to initialize database, exiting")
+    if not subreddit_str:
+        sys.exit("No subreddit configured (set SUBREDDITS or SUBREDDIT), exiting")
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
 
-    # Start all threads
-    threading.Thread(target=post_monitor, daemon=False).start()  # Changed to non-daemon
-    threading.Thread(target=keep_alive, daemon=False).start()    # Added keep-alive thread
-    comment_monitor()  # Run the main comment monitor in the main thread
+    worker = threading.Thread(target=command_worker, name="commands", daemon=True)
+    worker.start()
+    try:
+        stream_monitor()  # Run both streams in the main thread
+    finally:
+        # Shutdown has to fit the host's 30 second SIGTERM-to-SIGKILL window:
+        # up to 12 s for the worker to finish queued commands, 8 s to flush
+        # queued replies, then at most one reply request (REPLY_TIMEOUT) still
+        # in flight. Pooled connections are only closed once the worker has
+        # stopped using them
+        try:
+            WORK_QUEUE.put(None, timeout=2)
+            worker.join(timeout=10)
+        except queue.Full:
+            logger.warning("Command queue still full at shutdown, not waiting for the worker")
+        
+        if worker.is_alive():
+            logger.warning("Command worker still busy at shutdown, leaving database connections open")
+        else:
+            POOL.closeall()
+        
+        # The reply thread posts replies in order, so this marker completes
+        # once every reply queued before it has been posted
+        try:
+            REPLY_POOL.submit(lambda: None).result(timeout=8)
+        except FutureTimeoutError:
+            logger.warning("Replies still queued at shutdown, dropping them")
+        REPLY_SHUTDOWN.set()
+        REPLY_POOL.shutdown(wait=False, cancel_futures=True)
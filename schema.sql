@@ -39,8 +39,16 @@ Stores aggregate statistics about users
 ```sql
 CREATE INDEX idx_loans_lender ON loans(lender);
 CREATE INDEX idx_loans_borrower ON loans(borrower);
-CREATE INDEX idx_loans_status ON loans(status);
 CREATE INDEX idx_loans_date_created ON loans(date_created);
+
+-- Partial indexes over unpaid loans, used by the [REQ] post user summary
+CREATE INDEX idx_loans_lender_unpaid ON loans(lender, date_created DESC)
+    WHERE status IN ('active', 'confirmed', 'partially_repaid');
+CREATE INDEX idx_loans_borrower_unpaid ON loans(borrower, date_created DESC)
+    WHERE status IN ('active', 'confirmed', 'partially_repaid');
+
+-- Newest loan for a lender/borrower/currency/amount, used by refunds
+CREATE INDEX idx_loans_refund_lookup ON loans(lender, borrower, currency, amount, date_created DESC);
 ```
 
 ## Sample Queries